@@ -1,56 +1,137 @@
 from flask import Flask, request, jsonify, Response, stream_with_context, send_from_directory
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import load_only, selectinload, validates
 from datetime import datetime
 import os
+import sqlite3
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
 from dotenv import load_dotenv
-from cryptography.fernet import Fernet
+import orjson
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 import secrets
 import base64
+import threading
+from cachetools import LRUCache, TTLCache
 
 load_dotenv()
 
+# Naive datetimes in the models are utcnow values
+JSON_OPTIONS = orjson.OPT_NAIVE_UTC
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, used by jsonify and request.json."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=JSON_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Skip the str round-trip of dumps and send orjson's bytes directly
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=JSON_OPTIONS),
+                                        mimetype='application/json')
+
 app = Flask(__name__, static_folder='../frontend/build')
+app.json = OrjsonProvider(app)
 CORS(app)
 
 # Load or generate encryption key
 ENCRYPTION_KEY = os.getenv('ENCRYPTION_KEY')
 if not ENCRYPTION_KEY:
-    # Generate a new Fernet key
-    ENCRYPTION_KEY = Fernet.generate_key().decode()
-    with open('.env', 'a') as f:
-        f.write(f'\nENCRYPTION_KEY={ENCRYPTION_KEY}')
-    load_dotenv()
+    # Generate a new 256-bit AES key
+    ENCRYPTION_KEY = base64.urlsafe_b64encode(AESGCM.generate_key(bit_length=256)).decode()
+    app.logger.warning('Generated ephemeral ENCRYPTION_KEY; sessions will not survive restart. '
+                       'Set ENCRYPTION_KEY in the environment to persist them.')
+
+# Keys are 32 urlsafe-base64 bytes, so existing Fernet keys remain valid
+cipher = AESGCM(base64.urlsafe_b64decode(ENCRYPTION_KEY)[:32])
+NONCE_SIZE = 12
+
+def encrypt_api_key(api_key):
+    nonce = os.urandom(NONCE_SIZE)
+    return nonce + cipher.encrypt(nonce, api_key.encode(), None)
 
-cipher_suite = Fernet(ENCRYPTION_KEY.encode())
+def decrypt_api_key(encrypted_key):
+    return cipher.decrypt(encrypted_key[:NONCE_SIZE], encrypted_key[NONCE_SIZE:], None).decode()
+
+# Minimum interval in seconds between last_used writes for a session
+LAST_USED_INTERVAL = 60
+_last_used_flushed = TTLCache(maxsize=4096, ttl=LAST_USED_INTERVAL)
+_last_used_lock = threading.Lock()
+
+# Seconds a plaintext API key may stay in memory, on either cache below
+API_KEY_CACHE_TTL = 300
+
+# Decrypted API keys by session_id, so warm sessions skip the DB and decryption
+_key_cache = TTLCache(maxsize=1024, ttl=API_KEY_CACHE_TTL)
+_key_cache_lock = threading.Lock()
+
+# Configured Gemini models by API key
+_model_cache = TTLCache(maxsize=128, ttl=API_KEY_CACHE_TTL)
+_model_cache_lock = threading.Lock()
+
+# Serialized /prompts bodies by (fields, category); the version guards against
+# storing a body that was being built while a write invalidated the cache
+_prompts_cache = LRUCache(maxsize=256)
+_prompts_cache_version = 0
+_prompts_cache_lock = threading.Lock()
+
+# Sessions with a /chat/stream response in flight
+_active_streams = set()
+_active_streams_lock = threading.Lock()
 
 # Configure SQLite database
 basedir = os.path.abspath(os.path.dirname(__file__))
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'prompts.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Pool a connection per gunicorn thread (see gunicorn.conf.py), and wait on
+# the writer lock instead of failing fast
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.getenv('GUNICORN_THREADS', '32')),
+    'connect_args': {'check_same_thread': False, 'timeout': 30},
+}
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers proceed while a chat/message insert holds the writer lock
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA mmap_size=268435456')
+    cursor.close()
+
 class UserSession(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.String(64), unique=True, nullable=False)
-    encrypted_api_key = db.Column(db.Text, nullable=False)
+    encrypted_api_key = db.Column(db.LargeBinary, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_used = db.Column(db.DateTime, default=datetime.utcnow)
 
     def to_dict(self):
         return {
             'session_id': self.session_id,
-            'created_at': self.created_at.isoformat(),
-            'last_used': self.last_used.isoformat()
+            'created_at': self.created_at,
+            'last_used': self.last_used
         }
 
 class Chat(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    prompt_id = db.Column(db.Integer, db.ForeignKey('prompt.id'), nullable=False)
-    session_id = db.Column(db.String(64), db.ForeignKey('user_session.session_id'), nullable=False)
+    prompt_id = db.Column(db.Integer, db.ForeignKey('prompt.id'), nullable=False, index=True)
+    session_id = db.Column(db.String(64), db.ForeignKey('user_session.session_id'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     messages = db.relationship('Message', backref='chat', lazy=True, cascade='all, delete-orphan')
 
@@ -58,13 +139,13 @@ class Chat(db.Model):
         return {
             'id': self.id,
             'prompt_id': self.prompt_id,
-            'created_at': self.created_at.isoformat(),
+            'created_at': self.created_at,
             'messages': [message.to_dict() for message in self.messages]
         }
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'), nullable=False)
+    chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'), nullable=False, index=True)
     role = db.Column(db.String(50), nullable=False)
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -74,9 +155,13 @@ class Message(db.Model):
             'id': self.id,
             'role': self.role,
             'content': self.content,
-            'created_at': self.created_at.isoformat()
+            'created_at': self.created_at
         }
 
+def normalize_category(category):
+    # Python's lower() folds non-ASCII letters too, unlike SQLite's lower()
+    return category.lower()
+
 class Prompt(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
@@ -84,35 +169,110 @@ class Prompt(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     category = db.Column(db.String(100), nullable=False, default='General')
+    # normalize_category(category), kept in step by the validator below; backs
+    # the case-insensitive category filter in get_prompts
+    category_normalized = db.Column(db.String(100), nullable=False, default='general', index=True)
     chats = db.relationship('Chat', backref='prompt', lazy=True, cascade='all, delete-orphan')
 
+    @validates('category')
+    def validate_category(self, key, category):
+        self.category_normalized = normalize_category(category)
+        return category
+
     def to_dict(self):
         return {
             'id': self.id,
             'title': self.title,
             'content': self.content,
-            'created_at': self.created_at.isoformat(),
-            'updated_at': self.updated_at.isoformat(),
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+            'category': self.category
+        }
+
+    def to_summary_dict(self):
+        return {
+            'id': self.id,
+            'title': self.title,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
             'category': self.category
         }
 
+def stream_json_array(query, batch_size=100, on_complete=None, serialize=None):
+    """Stream query results as a JSON array, fetching rows in batches.
+
+    Rows are serialized with serialize(row), defaulting to row.to_dict(). If
+    given, on_complete is called with the full body once it has been sent.
+    """
+    serialize = serialize or (lambda row: row.to_dict())
+
+    def generate():
+        chunks = []
+        separator = b'['
+        for row in query.yield_per(batch_size):
+            chunk = separator + orjson.dumps(serialize(row), option=JSON_OPTIONS)
+            if on_complete:
+                chunks.append(chunk)
+            yield chunk
+            separator = b','
+        # An empty result never emitted the opening bracket
+        chunk = b']' if separator == b',' else b'[]'
+        yield chunk
+        if on_complete:
+            chunks.append(chunk)
+            on_complete(b''.join(chunks))
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+def invalidate_prompts_cache():
+    global _prompts_cache_version
+    with _prompts_cache_lock:
+        _prompts_cache.clear()
+        _prompts_cache_version += 1
+
 @app.route('/', methods=['GET'])
 def index():
     return jsonify({'status': 'ok', 'message': 'Server is running'})
 
+@app.route('/static/<path:filename>', methods=['GET'])
+def serve_static_asset(filename):
+    # Build assets carry a content hash in their filenames, so they never change
+    response = send_from_directory(os.path.join(app.static_folder, 'static'), filename)
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/prompts', methods=['GET'])
 def get_prompts():
     category = request.args.get('category', '').strip()
+    # ?fields=summary omits prompt content, for listings that only show titles
+    summary = request.args.get('fields') == 'summary'
+    cache_key = ('summary' if summary else 'full', normalize_category(category) or '__all__')
+    
+    with _prompts_cache_lock:
+        body = _prompts_cache.get(cache_key)
+        version = _prompts_cache_version
+    if body is not None:
+        return Response(body, mimetype='application/json')
     
-    # Get all prompts first
-    all_prompts = Prompt.query.order_by(Prompt.created_at.desc()).all()
+    def store(body):
+        with _prompts_cache_lock:
+            if version == _prompts_cache_version:
+                _prompts_cache[cache_key] = body
     
+    query = Prompt.query
+    serialize = None
+    if summary:
+        query = query.options(load_only(Prompt.id, Prompt.title, Prompt.category,
+                                        Prompt.created_at, Prompt.updated_at))
+        serialize = Prompt.to_summary_dict
     if category:
-        # Case-insensitive filtering
-        filtered_prompts = [p for p in all_prompts if p.category and p.category.lower() == category.lower()]
-        return jsonify([p.to_dict() for p in filtered_prompts])
+        # Case-insensitive filtering, done in SQL so only matching rows are loaded
+        query = query.filter(Prompt.category_normalized == normalize_category(category))
     
-    return jsonify([p.to_dict() for p in all_prompts])
+    return stream_json_array(query.order_by(Prompt.created_at.desc()),
+                             on_complete=store, serialize=serialize)
 
 @app.route('/prompts', methods=['POST'])
 def create_prompt():
@@ -126,6 +286,7 @@ def create_prompt():
     )
     db.session.add(new_prompt)
     db.session.commit()
+    invalidate_prompts_cache()
     return jsonify(new_prompt.to_dict()), 201
 
 @app.route('/prompts/<int:prompt_id>', methods=['PUT'])
@@ -138,6 +299,7 @@ def update_prompt(prompt_id):
     prompt.category = data.get('category', prompt.category)
     
     db.session.commit()
+    invalidate_prompts_cache()
     return jsonify(prompt.to_dict())
 
 @app.route('/prompts/<int:prompt_id>', methods=['DELETE'])
@@ -145,12 +307,16 @@ def delete_prompt(prompt_id):
     prompt = Prompt.query.get_or_404(prompt_id)
     db.session.delete(prompt)
     db.session.commit()
+    invalidate_prompts_cache()
     return '', 204
 
 @app.route('/chats/<int:prompt_id>', methods=['GET'])
 def get_chats(prompt_id):
-    chats = Chat.query.filter_by(prompt_id=prompt_id).order_by(Chat.created_at.desc()).all()
-    return jsonify([chat.to_dict() for chat in chats])
+    # Load messages per batch in one extra query instead of one lazy query per chat
+    chats = (Chat.query.options(selectinload(Chat.messages))
+             .filter_by(prompt_id=prompt_id)
+             .order_by(Chat.created_at.desc()))
+    return stream_json_array(chats)
 
 @app.route('/settings/api-key', methods=['POST'])
 def update_api_key():
@@ -161,16 +327,17 @@ def update_api_key():
         return jsonify({"error": "API key is required"}), 400
     
     try:
-        # Test the API key
-        genai.configure(api_key=new_key)
-        test_model = genai.GenerativeModel('gemini-pro')
-        test_model.generate_content('test')
+        # Test the API key with an auth-only call instead of a model request, on
+        # a client of its own so the global genai configuration is left alone
+        test_client = glm.ModelServiceClient(client_options={'api_key': new_key})
+        if next(iter(genai.list_models(client=test_client)), None) is None:
+            return jsonify({"error": "API key has no access to any Gemini models"}), 400
         
         # Generate a new session ID
-        session_id = secrets.token_urlsafe(32)
+        session_id = secrets.token_urlsafe(16)
         
         # Encrypt the API key
-        encrypted_key = cipher_suite.encrypt(new_key.encode()).decode()
+        encrypted_key = encrypt_api_key(new_key)
         
         # Store in database
         session = UserSession(
@@ -187,23 +354,86 @@ def update_api_key():
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
+def touch_session(session_id):
+    # Update last used timestamp, at most once per LAST_USED_INTERVAL
+    with _last_used_lock:
+        if session_id in _last_used_flushed:
+            return
+    try:
+        UserSession.query.filter_by(session_id=session_id).update({'last_used': datetime.utcnow()})
+        db.session.commit()
+    except SQLAlchemyError:
+        # last_used is best-effort; skip it rather than fail the request
+        db.session.rollback()
+        return
+    with _last_used_lock:
+        _last_used_flushed[session_id] = True
+
 def get_api_key_from_session(session_id):
     if not session_id:
         return None
+    
+    with _key_cache_lock:
+        api_key = _key_cache.get(session_id)
+    
+    if not api_key:
+        session = UserSession.query.filter_by(session_id=session_id).first()
+        if not session:
+            return None
         
-    session = UserSession.query.filter_by(session_id=session_id).first()
-    if not session:
-        return None
-        
-    try:
-        # Update last used timestamp
-        session.last_used = datetime.utcnow()
-        db.session.commit()
-        
-        # Decrypt and return the API key
-        return cipher_suite.decrypt(session.encrypted_api_key.encode()).decode()
-    except:
-        return None
+        try:
+            # Decrypt the API key
+            api_key = decrypt_api_key(session.encrypted_api_key)
+        except:
+            return None
+        with _key_cache_lock:
+            _key_cache[session_id] = api_key
+    
+    touch_session(session_id)
+    return api_key
+
+def save_message(chat_id, role, content):
+    # Plain INSERT; the row is never read back, so skip the ORM unit of work
+    db.session.execute(Message.__table__.insert().values(chat_id=chat_id, role=role, content=content))
+
+def build_history(chat):
+    """Rebuild a saved chat as Gemini multi-turn history."""
+    messages = Message.query.filter_by(chat_id=chat.id).order_by(Message.id).all()
+    history = []
+    # Gemini requires strictly alternating turns, so keep only answered user messages
+    for user_msg, reply in zip(messages, messages[1:]):
+        if user_msg.role == 'user' and reply.role == 'assistant':
+            history.append({'role': 'user', 'parts': [user_msg.content]})
+            history.append({'role': 'model', 'parts': [reply.content]})
+    if history and chat.prompt:
+        # The prompt was only sent with the first turn, it is not stored with it
+        first = history[0]['parts'][0]
+        history[0]['parts'] = [f"{chat.prompt.content}\n\nUser: {first}"]
+    return history
+
+def get_model(api_key):
+    with _model_cache_lock:
+        model = _model_cache.get(api_key)
+        if model is None:
+            model = genai.GenerativeModel('gemini-pro')
+            # Bind a client for this key now; left unset, the model would pick up
+            # whichever key genai.configure last set when it is first used.
+            # _client is private; this relies on google-generativeai==0.3.2 being pinned
+            model._client = glm.GenerativeServiceClient(client_options={'api_key': api_key})
+            _model_cache[api_key] = model
+    return model
+
+def start_stream(session_id):
+    """Claim the session's stream slot; False if a stream is already running."""
+    with _active_streams_lock:
+        if session_id in _active_streams:
+            return False
+        _active_streams.add(session_id)
+        return True
+
+def end_stream(session_id):
+    with _active_streams_lock:
+        _active_streams.discard(session_id)
 
 @app.route('/chat/stream', methods=['POST'])
 def stream_chat():
@@ -220,44 +450,63 @@ def stream_chat():
     prompt_id = data.get('prompt_id')
     chat_id = data.get('chat_id')
     
-    # Configure Gemini with the current API key
-    genai.configure(api_key=api_key)
-    chat_model = genai.GenerativeModel('gemini-pro')
+    chat_model = get_model(api_key)
     
     # Only include prompt if it's provided (first message)
     full_prompt = f"{prompt_text}\n\nUser: {user_input}" if prompt_text else user_input
     
-    # Create or get chat session
-    chat = None
-    if chat_id:
-        chat = Chat.query.get(chat_id)
-    elif prompt_id:
-        chat = Chat(prompt_id=prompt_id, session_id=session_id)
-        db.session.add(chat)
-        db.session.commit()
+    # One stream per session at a time, so a session never has concurrent chat writes
+    if not start_stream(session_id):
+        return jsonify({"error": "A response is already being generated for this session."}), 429
     
-    # Save user message
-    if chat:
-        message = Message(chat_id=chat.id, role='user', content=user_input)
-        db.session.add(message)
-        db.session.commit()
+    try:
+        # Create or get chat session
+        chat = None
+        history = []
+        if chat_id:
+            chat = Chat.query.get(chat_id)
+            if chat:
+                history = build_history(chat)
+        elif prompt_id:
+            chat = Chat(prompt_id=prompt_id, session_id=session_id)
+            db.session.add(chat)
+            # Assign chat.id without committing yet
+            db.session.flush()
+        
+        # Save user message, committed together with a new chat
+        if chat:
+            save_message(chat.id, 'user', user_input)
+            db.session.commit()
+    except:
+        end_stream(session_id)
+        raise
     
     def generate():
-        response = chat_model.generate_content(full_prompt, stream=True)
-        ai_response = ""
+        if history:
+            # Continue the saved conversation instead of sending a standalone prompt
+            chat_session = chat_model.start_chat(history=history)
+            response = chat_session.send_message(user_input, stream=True)
+        else:
+            response = chat_model.generate_content(full_prompt, stream=True)
+        parts = []
         
         for chunk in response:
-            if chunk.text:
-                ai_response += chunk.text
-                yield f"data: {chunk.text}\n\n"
+            text = chunk.text
+            if text:
+                parts.append(text)
+                yield b"data: " + text.encode('utf-8') + b"\n\n"
+        
+        ai_response = ''.join(parts)
         
         # Save assistant message after complete response
         if chat and ai_response:
-            message = Message(chat_id=chat.id, role='assistant', content=ai_response)
-            db.session.add(message)
+            save_message(chat.id, 'assistant', ai_response)
             db.session.commit()
     
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    # Runs when the server closes the response, even if the client disconnects early
+    response.call_on_close(lambda: end_stream(session_id))
+    return response
 
 if __name__ == '__main__':
     with app.app_context():
@@ -0,0 +1,14 @@
+# Gunicorn settings, picked up automatically by `gunicorn app:app` in this directory
+import os
+
+bind = os.getenv('GUNICORN_BIND', '127.0.0.1:5001')
+
+# A streamed Gemini reply holds its request for the whole response; serve
+# requests from a thread pool rather than one at a time per sync worker.
+# app.py sizes the SQLAlchemy pool from the same GUNICORN_THREADS, so set the
+# thread count through that variable rather than --threads
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '32'))
+
+# Single process: SQLite has one writer and the session/model caches are per-process
+workers = 1